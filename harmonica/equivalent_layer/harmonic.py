@@ -7,14 +7,23 @@
 """
 Equivalent layer for generic harmonic functions in Cartesian coordinates
 """
+from warnings import warn
 import numpy as np
 from numba import jit
 from sklearn.utils.validation import check_is_fitted
 import verde as vd
 import verde.base as vdb
 
-from .utils import jacobian_numba, predict_numba, pop_extra_coords
-from ..forward.utils import distance_cartesian
+from .utils import (
+    jacobian_numba,
+    predict_numba,
+    pop_extra_coords,
+    least_squares,
+    least_squares_matrix_free,
+    MAX_JACOBIAN_SIZE,
+    FASTMATH_FLAGS,
+    MAX_NUMPY_SIZE,
+)
 
 
 class EQLHarmonic(vdb.BaseGridder):
@@ -43,7 +52,9 @@ class EQLHarmonic(vdb.BaseGridder):
     points by default [Cooper2000]_. Custom source locations can be used by
     specifying the *points* argument. Coefficients associated with each point
     source are estimated through linear least-squares with damping (Tikhonov
-    0th order) regularization.
+    0th order) regularization. If the Jacobian matrix would be too large to fit
+    in memory and *damping* is given, the least-squares problem is solved
+    approximately through LSQR without building the Jacobian.
 
     The Green's function for point mass effects used is the inverse Euclidean
     distance between the grid coordinates and the point source:
@@ -146,8 +157,27 @@ class EQLHarmonic(vdb.BaseGridder):
             )
         else:
             self.points_ = vdb.n_1d_arrays(self.points, 3)
-        jacobian = self.jacobian(coordinates, self.points_)
-        self.coefs_ = vdb.least_squares(jacobian, data, weights, self.damping)
+        too_large = coordinates[0].size * self.points_[0].size > MAX_JACOBIAN_SIZE
+        if too_large and self.damping is None:
+            warn(
+                "Building a Jacobian matrix with more than {} elements. ".format(
+                    MAX_JACOBIAN_SIZE
+                )
+                + "Pass a damping parameter to fit without building it."
+            )
+        if too_large and self.damping is not None:
+            # Avoid allocating the Jacobian matrix for large damped problems
+            self.coefs_ = least_squares_matrix_free(
+                coordinates,
+                self.points_,
+                data,
+                weights,
+                self.damping,
+                self.greens_function,
+            )
+        else:
+            jacobian = self.jacobian(coordinates, self.points_)
+            self.coefs_ = least_squares(jacobian, data, weights, self.damping)
         return self
 
     def predict(self, coordinates):
@@ -175,9 +205,16 @@ class EQLHarmonic(vdb.BaseGridder):
         size = np.broadcast(*coordinates[:3]).size
         dtype = coordinates[0].dtype
         coordinates = tuple(np.atleast_1d(i).ravel() for i in coordinates[:3])
+        if size * self.points_[0].size < MAX_NUMPY_SIZE:
+            # Avoid the Numba compilation overhead on small problems
+            data = (
+                jacobian_numpy(coordinates, self.points_, self.greens_function)
+                @ self.coefs_
+            )
+            return data.astype(dtype).reshape(shape)
         data = np.zeros(size, dtype=dtype)
         predict_numba(
-            coordinates, self.points_, self.coefs_, data, self.greens_function
+            *coordinates, *self.points_, self.coefs_, data, self.greens_function
         )
         return data.reshape(shape)
 
@@ -202,7 +239,11 @@ class EQLHarmonic(vdb.BaseGridder):
             used as equivalent layer in the following order:
             (``easting``, ``northing``, ``upward``).
         dtype : str or numpy dtype
-            The type of the Jacobian array.
+            The type of the Jacobian array. The Green's functions are always
+            evaluated in double precision. Using ``"float32"`` halves the
+            memory needed to store the Jacobian, but the misfit of the fitted
+            coefficients can grow to about 1e-4 of the data amplitude.
+            Default ``"float64"``.
 
         Returns
         -------
@@ -212,8 +253,13 @@ class EQLHarmonic(vdb.BaseGridder):
         # Compute Jacobian matrix
         n_data = coordinates[0].size
         n_points = points[0].size
+        if n_data * n_points < MAX_NUMPY_SIZE:
+            # Avoid the Numba compilation overhead on small problems
+            return jacobian_numpy(coordinates, points, self.greens_function).astype(
+                dtype
+            )
         jac = np.zeros((n_data, n_points), dtype=dtype)
-        jacobian_numba(coordinates, points, jac, self.greens_function)
+        jacobian_numba(*coordinates, *points, jac, self.greens_function)
         return jac
 
     def grid(
@@ -420,14 +466,36 @@ class EQLHarmonic(vdb.BaseGridder):
         return table
 
 
-@jit(nopython=True)
+@jit(nopython=True, fastmath=FASTMATH_FLAGS, error_model="numpy")
 def greens_func_cartesian(east, north, upward, point_east, point_north, point_upward):
     """
     Green's function for the equivalent layer in Cartesian coordinates
 
-    Uses Numba to speed up things.
+    Uses Numba to speed up things. The inverse distance is computed in a single
+    expression (instead of calling
+    :func:`harmonica.forward.utils.distance_cartesian`) so the square root and
+    the division can be fused by the compiler. Divisions by zero are not
+    checked (``error_model="numpy"``), which lets the loops calling this
+    function be vectorized. A point source located on the observation point
+    gives an infinite value, which is rejected by the least-squares solvers.
+    """
+    d_east = east - point_east
+    d_north = north - point_north
+    d_upward = upward - point_upward
+    return 1 / np.sqrt(d_east * d_east + d_north * d_north + d_upward * d_upward)
+
+
+def jacobian_numpy(coordinates, points, greens_function):
+    """
+    Make the Jacobian matrix for the equivalent layer using NumPy broadcasting
+
+    Evaluates the Python version of the Numba jitted ``greens_function`` (like
+    :func:`greens_func_cartesian`) on every pair of observation point and point
+    source at once. Used instead of
+    :func:`harmonica.equivalent_layer.utils.jacobian_numba` on small problems,
+    for which compiling the Numba kernel takes longer than running it.
     """
-    distance = distance_cartesian(
-        (east, north, upward), (point_east, point_north, point_upward)
-    )
-    return 1 / distance
+    # With Numba jit disabled the Green's function is a plain Python function
+    greens_function = getattr(greens_function, "py_func", greens_function)
+    east, north, upward = (np.ravel(i)[:, np.newaxis] for i in coordinates[:3])
+    return greens_function(east, north, upward, *points[:3])
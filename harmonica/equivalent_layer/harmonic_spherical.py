@@ -7,13 +7,22 @@
 """
 Equivalent layer for generic harmonic functions in spherical coordinates
 """
+from warnings import warn
 import numpy as np
 from numba import jit
 from sklearn.utils.validation import check_is_fitted
 import verde as vd
 import verde.base as vdb
 
-from .utils import jacobian_numba, predict_numba, pop_extra_coords
+from .utils import (
+    jacobian_numba,
+    predict_numba,
+    pop_extra_coords,
+    least_squares,
+    least_squares_matrix_free,
+    MAX_JACOBIAN_SIZE,
+    FASTMATH_FLAGS,
+)
 from ..forward.utils import distance_spherical
 
 
@@ -44,7 +53,9 @@ class EQLHarmonicSpherical(vdb.BaseGridder):
     points by default [Cooper2000]_. Custom source locations can be used by
     specifying the *points* argument. Coefficients associated with each point
     source are estimated through linear least-squares with damping (Tikhonov
-    0th order) regularization.
+    0th order) regularization. If the Jacobian matrix would be too large to fit
+    in memory and *damping* is given, the least-squares problem is solved
+    approximately through LSQR without building the Jacobian.
 
     The Green's function for point mass effects used is the inverse Euclidean
     distance between the grid coordinates and the point source:
@@ -148,8 +159,27 @@ class EQLHarmonicSpherical(vdb.BaseGridder):
             )
         else:
             self.points_ = vdb.n_1d_arrays(self.points, 3)
-        jacobian = self.jacobian(coordinates, self.points_)
-        self.coefs_ = vdb.least_squares(jacobian, data, weights, self.damping)
+        too_large = coordinates[0].size * self.points_[0].size > MAX_JACOBIAN_SIZE
+        if too_large and self.damping is None:
+            warn(
+                "Building a Jacobian matrix with more than {} elements. ".format(
+                    MAX_JACOBIAN_SIZE
+                )
+                + "Pass a damping parameter to fit without building it."
+            )
+        if too_large and self.damping is not None:
+            # Avoid allocating the Jacobian matrix for large damped problems
+            self.coefs_ = least_squares_matrix_free(
+                coordinates,
+                self.points_,
+                data,
+                weights,
+                self.damping,
+                self.greens_function,
+            )
+        else:
+            jacobian = self.jacobian(coordinates, self.points_)
+            self.coefs_ = least_squares(jacobian, data, weights, self.damping)
         return self
 
     def predict(self, coordinates):
@@ -180,7 +210,7 @@ class EQLHarmonicSpherical(vdb.BaseGridder):
         coordinates = tuple(np.atleast_1d(i).ravel() for i in coordinates[:3])
         data = np.zeros(size, dtype=dtype)
         predict_numba(
-            coordinates, self.points_, self.coefs_, data, self.greens_function
+            *coordinates, *self.points_, self.coefs_, data, self.greens_function
         )
         return data.reshape(shape)
 
@@ -205,7 +235,11 @@ class EQLHarmonicSpherical(vdb.BaseGridder):
             used as equivalent layer in the following order:
             (``longitude``, ``latitude``, ``radius``).
         dtype : str or numpy dtype
-            The type of the Jacobian array.
+            The type of the Jacobian array. The Green's functions are always
+            evaluated in double precision. Using ``"float32"`` halves the
+            memory needed to store the Jacobian, but the misfit of the fitted
+            coefficients can grow to about 1e-4 of the data amplitude.
+            Default ``"float64"``.
 
         Returns
         -------
@@ -216,7 +250,7 @@ class EQLHarmonicSpherical(vdb.BaseGridder):
         n_data = coordinates[0].size
         n_points = points[0].size
         jac = np.zeros((n_data, n_points), dtype=dtype)
-        jacobian_numba(coordinates, points, jac, self.greens_function)
+        jacobian_numba(*coordinates, *points, jac, self.greens_function)
         return jac
 
     def grid(
@@ -336,14 +370,16 @@ class EQLHarmonicSpherical(vdb.BaseGridder):
         raise NotImplementedError
 
 
-@jit(nopython=True)
+@jit(nopython=True, fastmath=FASTMATH_FLAGS, error_model="numpy")
 def greens_func_spherical(
     longitude, latitude, radius, point_longitude, point_latitude, point_radius
 ):
     """
     Green's function for the equivalent layer in spherical coordinates
 
-    Uses Numba to speed up things.
+    Uses Numba to speed up things. Divisions by zero are not checked
+    (``error_model="numpy"``) like in
+    :func:`harmonica.equivalent_layer.harmonic.greens_func_cartesian`.
     """
     distance = distance_spherical(
         (longitude, latitude, radius), (point_longitude, point_latitude, point_radius)
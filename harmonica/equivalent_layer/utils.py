@@ -7,36 +7,92 @@
 """
 Utility functions for equivalent layer gridders
 """
+
 from warnings import warn
+import numpy as np
 from numba import jit, prange
+from scipy.linalg import get_lapack_funcs, lstsq
+from scipy.sparse.linalg import LinearOperator, lsqr
+
+# Number of point sources in each block processed by the Numba kernels. Each
+# block of point sources (their coordinates and coefficients) fits in the L2
+# cache and is reused for every observation point handled by the same thread.
+BLOCK_POINTS = 4096
+
+# Maximum number of elements of the Jacobian matrix that will be allocated when
+# fitting a damped equivalent layer (800 MB in double precision). Larger damped
+# problems are solved without building the Jacobian (see
+# least_squares_matrix_free). Solving the dense problem with least_squares
+# needs extra memory: about 1.1 times the Jacobian without damping and the size
+# of the damped augmented matrix (about 2 times the Jacobian when there are as
+# many data as point sources) with damping. So the peak memory of a dense fit
+# of this size can reach about 2.4 GB.
+MAX_JACOBIAN_SIZE = int(1e8)
+
+# Number of Jacobian columns whose standard deviation is computed at once by
+# least_squares.
+SCALE_CHUNK_SIZE = 256
+
+# Maximum number of LSQR iterations used by least_squares_matrix_free. Each
+# iteration costs two evaluations of the Green's function for every pair of
+# observation point and point source.
+MAX_LSQR_ITERATIONS = 1000
+
+# Problems with fewer elements in their Jacobian matrix than this are solved
+# with NumPy when possible, since compiling the Numba kernels would take longer
+# than running them.
+MAX_NUMPY_SIZE = int(1e4)
+
+# LLVM fast-math flags of the Numba kernels and Green's functions. They let
+# the compiler vectorize the loops (reassociation and fused multiply-add), but
+# leave out the no-NaNs and no-infinities assumptions. So a point source
+# located on an observation point gives an infinite Green's function that can
+# be detected before solving, instead of undefined behaviour.
+FASTMATH_FLAGS = {"nsz", "arcp", "contract", "afn", "reassoc"}
 
 
-@jit(nopython=True, parallel=True)
-def jacobian_numba(coordinates, points, jac, greens_function):
+@jit(nopython=True, parallel=True, fastmath=FASTMATH_FLAGS)
+def jacobian_numba(
+    east, north, upward, point_east, point_north, point_upward, jac, greens_function
+):  # pylint: disable=not-an-iterable
     """
     Calculate the Jacobian matrix using numba to speed things up.
 
     It works both for Cartesian and spherical coordiantes. We need to pass the
     corresponding Green's function through the ``greens_function`` argument.
     The Jacobian is built in parallel in order to reduce the computation time.
+    It's filled in blocks of ``BLOCK_POINTS`` point sources so the coordinates
+    of the point sources are read from cache instead of main memory. The
+    observation points are distributed among the threads within each block.
     """
-    east, north, upward = coordinates[:]
-    point_east, point_north, point_upward = points[:]
-    for i in prange(east.size):
-        for j in range(point_east.size):
-            jac[i, j] = greens_function(
-                east[i],
-                north[i],
-                upward[i],
-                point_east[j],
-                point_north[j],
-                point_upward[j],
-            )
+    n_data, n_points = east.size, point_east.size
+    for j_start in range(0, n_points, BLOCK_POINTS):
+        j_end = min(j_start + BLOCK_POINTS, n_points)
+        for i in prange(n_data):
+            # Read the coordinates of the observation point only once
+            east_i, north_i, upward_i = east[i], north[i], upward[i]
+            for j in range(j_start, j_end):
+                jac[i, j] = greens_function(
+                    east_i,
+                    north_i,
+                    upward_i,
+                    point_east[j],
+                    point_north[j],
+                    point_upward[j],
+                )
 
 
-@jit(nopython=True, parallel=True)
+@jit(nopython=True, parallel=True, fastmath=FASTMATH_FLAGS)
 def predict_numba(
-    coordinates, points, coeffs, result, greens_function
+    east,
+    north,
+    upward,
+    point_east,
+    point_north,
+    point_upward,
+    coeffs,
+    result,
+    greens_function,
 ):  # pylint: disable=not-an-iterable
     """
     Calculate the predicted data using numba for speeding things up.
@@ -44,19 +100,276 @@ def predict_numba(
     It works both for Cartesian and spherical coordiantes. We need to pass the
     corresponding Green's function through the ``greens_function`` argument.
     The prediction is run in parallel in order to reduce the computation time.
+    Point sources are processed in blocks (like in :func:`jacobian_numba`) and
+    each thread accumulates the contribution of a block of point sources in a
+    local variable before updating ``result``.
+    """
+    n_data, n_points = east.size, point_east.size
+    for j_start in range(0, n_points, BLOCK_POINTS):
+        j_end = min(j_start + BLOCK_POINTS, n_points)
+        for i in prange(n_data):
+            east_i, north_i, upward_i = east[i], north[i], upward[i]
+            accumulated = 0.0
+            for j in range(j_start, j_end):
+                accumulated += coeffs[j] * greens_function(
+                    east_i,
+                    north_i,
+                    upward_i,
+                    point_east[j],
+                    point_north[j],
+                    point_upward[j],
+                )
+            result[i] += accumulated
+
+
+@jit(nopython=True, parallel=True, fastmath=FASTMATH_FLAGS)
+def jacobian_transpose_numba(
+    east,
+    north,
+    upward,
+    point_east,
+    point_north,
+    point_upward,
+    residuals,
+    result,
+    greens_function,
+):  # pylint: disable=not-an-iterable
     """
-    east, north, upward = coordinates[:]
-    point_east, point_north, point_upward = points[:]
-    for i in prange(east.size):
-        for j in range(point_east.size):
-            result[i] += coeffs[j] * greens_function(
-                east[i],
-                north[i],
-                upward[i],
-                point_east[j],
-                point_north[j],
-                point_upward[j],
+    Multiply the transposed Jacobian by a vector without building the Jacobian.
+
+    Structurally identical to :func:`predict_numba`, but the parallel loop runs
+    over the point sources and the sum over the observation points.
+    """
+    for j in prange(point_east.size):
+        east_j, north_j, upward_j = point_east[j], point_north[j], point_upward[j]
+        accumulated = 0.0
+        for i in range(east.size):
+            accumulated += residuals[i] * greens_function(
+                east[i], north[i], upward[i], east_j, north_j, upward_j
+            )
+        result[j] += accumulated
+
+
+@jit(nopython=True, parallel=True, fastmath=FASTMATH_FLAGS)
+def jacobian_std_numba(
+    east, north, upward, point_east, point_north, point_upward, result, greens_function
+):  # pylint: disable=not-an-iterable
+    """
+    Compute the standard deviation of each column of the Jacobian matrix.
+
+    Evaluates the Green's functions on the fly instead of building the
+    Jacobian.
+    """
+    for j in prange(point_east.size):
+        east_j, north_j, upward_j = point_east[j], point_north[j], point_upward[j]
+        total, total_squares = 0.0, 0.0
+        for i in range(east.size):
+            element = greens_function(
+                east[i], north[i], upward[i], east_j, north_j, upward_j
             )
+            total += element
+            total_squares += element * element
+        mean = total / east.size
+        result[j] = np.sqrt(max(total_squares / east.size - mean * mean, 0.0))
+
+
+def least_squares(jacobian, data, weights, damping=None):
+    """
+    Solve a weighted least-squares problem with optional damping regularization
+
+    Equivalent to :func:`verde.base.least_squares`, but solved directly with
+    LAPACK through :func:`scipy.linalg.lstsq` instead of scikit-learn
+    estimators. The Jacobian columns are scaled to unit variance (the scaling
+    is undone before returning the parameters). The weights are applied by
+    multiplying each row of the Jacobian and each datum by the square root of
+    its weight. The damping is applied by appending ``sqrt(damping)`` times the
+    identity matrix to the Jacobian, so the normal equations are never formed,
+    and the augmented system is solved through a QR factorization (LAPACK
+    ``gels``).
+
+    .. warning::
+
+        The Jacobian matrix is scaled inplace.
+
+    Parameters
+    ----------
+    jacobian : 2d-array
+        The Jacobian/sensitivity/feature matrix.
+    data : array
+        The data values of each data point.
+    weights : None or array
+        If not None, then the weights assigned to each data point.
+    damping : None or float
+        The positive damping (Tikhonov 0th order) regularization parameter. If
+        ``damping=None``, will use a regular least-squares fit.
+
+    Returns
+    -------
+    parameters : 1d-array
+        The estimated 1D array of parameters that fit the data.
+    """
+    n_data, n_points = jacobian.shape
+    if n_data < n_points:
+        warn(
+            "Under-determined problem detected (ndata, nparams)={}.".format(
+                (n_data, n_points)
+            )
+        )
+    data = np.ravel(data)
+    # Compute the standard deviation of a few columns at a time to avoid
+    # allocating a temporary array as large as the Jacobian
+    scale = np.empty(n_points)
+    for start in range(0, n_points, SCALE_CHUNK_SIZE):
+        end = start + SCALE_CHUNK_SIZE
+        scale[start:end] = jacobian[:, start:end].std(axis=0)
+    # The standard deviation of a column is finite only if all of its elements
+    # are, so checking the scales is enough to validate the Jacobian without
+    # the full-size temporary array allocated by lstsq(check_finite=True).
+    check_finite_input(scale, data, weights)
+    # Leave columns with zero variance unscaled (like StandardScaler)
+    scale[scale == 0] = 1
+    jacobian /= scale
+    if weights is not None:
+        sqrt_weights = np.sqrt(np.ravel(weights))
+        jacobian *= sqrt_weights[:, np.newaxis]
+        data = sqrt_weights * data
+    if damping is None:
+        params = lstsq(
+            jacobian, data, lapack_driver="gelsd", overwrite_a=True, check_finite=False
+        )[0]
+    else:
+        # Allocate the augmented matrix in Fortran order so LAPACK can
+        # overwrite it instead of making another copy
+        augmented = np.zeros((n_data + n_points, n_points), order="F")
+        augmented[:n_data] = jacobian
+        diagonal = np.arange(n_points)
+        augmented[n_data + diagonal, diagonal] = np.sqrt(damping)
+        data = np.concatenate((data, np.zeros(n_points)))
+        # Call the QR based LAPACK driver directly: scipy.linalg.lstsq copies
+        # the matrix even when asked to overwrite it. The damping guarantees
+        # that the augmented matrix has full rank.
+        gels, gels_lwork = get_lapack_funcs(("gels", "gels_lwork"), (augmented,))
+        lwork = int(gels_lwork(n_data + n_points, n_points, 1)[0])
+        _, solution, info = gels(
+            augmented, data, lwork=lwork, overwrite_a=True, overwrite_b=True
+        )
+        if info != 0:
+            raise np.linalg.LinAlgError("LAPACK gels failed with info={}.".format(info))
+        params = solution[:n_points]
+    return params / scale
+
+
+def check_finite_input(scale, data, weights):
+    """
+    Check that the least-squares problem doesn't have non-finite values
+
+    Raises a ValueError if the standard deviations of the Jacobian columns
+    (``scale``), the data or the weights contain NaNs or infinities.
+    """
+    if not np.isfinite(scale).all():
+        raise ValueError(
+            "Found non-finite values in the Jacobian matrix. "
+            + "Make sure that no point source is located on an observation point."
+        )
+    if not np.isfinite(data).all():
+        raise ValueError("Found non-finite data values.")
+    if weights is not None and not np.isfinite(weights).all():
+        raise ValueError("Found non-finite weights.")
+
+
+def least_squares_matrix_free(
+    coordinates, points, data, weights, damping, greens_function
+):
+    """
+    Solve the equivalent layer least-squares problem without the Jacobian.
+
+    Solves the same problem as :func:`least_squares` (including the scaling of
+    the Jacobian columns to unit variance), but the products of the Jacobian
+    with vectors are computed on the fly with Numba and the problem is solved
+    iteratively with :func:`scipy.sparse.linalg.lsqr`. The memory needed is
+    proportional to the number of data and point sources instead of their
+    product.
+
+    The solution is an approximation: LSQR stops after
+    ``MAX_LSQR_ITERATIONS`` iterations (a warning is raised if it hasn't
+    converged by then). Damping is required, since LSQR doesn't converge in a
+    reasonable number of iterations for the ill-conditioned undamped
+    equivalent layer problems.
+
+    Parameters
+    ----------
+    coordinates : tuple of arrays
+        Arrays with the coordinates of each data point.
+    points : tuple of arrays
+        Arrays with the coordinates of each point source.
+    data : array
+        The data values of each data point.
+    weights : None or array
+        If not None, then the weights assigned to each data point.
+    damping : float
+        The positive damping (Tikhonov 0th order) regularization parameter.
+    greens_function : func
+        Numba jitted Green's function of the equivalent layer.
+
+    Returns
+    -------
+    coefs : array
+        The estimated coefficients of every point source.
+    """
+    if damping is None:
+        raise ValueError(
+            "The matrix-free least-squares solver requires a damping parameter."
+        )
+    n_data, n_points = coordinates[0].size, points[0].size
+    if n_data < n_points:
+        warn(
+            "Under-determined problem detected (ndata, nparams)={}.".format(
+                (n_data, n_points)
+            )
+        )
+    data = np.ravel(data)
+    if weights is None:
+        sqrt_weights = np.ones(n_data)
+    else:
+        sqrt_weights = np.sqrt(np.ravel(weights))
+    scale = np.zeros(n_points)
+    jacobian_std_numba(*coordinates, *points, scale, greens_function)
+    check_finite_input(scale, data, weights)
+    # Leave columns with zero variance unscaled (like StandardScaler)
+    scale[scale == 0] = 1
+
+    def matvec(coefs):
+        result = np.zeros(n_data)
+        predict_numba(
+            *coordinates, *points, np.ravel(coefs) / scale, result, greens_function
+        )
+        return sqrt_weights * result
+
+    def rmatvec(residuals):
+        result = np.zeros(n_points)
+        jacobian_transpose_numba(
+            *coordinates,
+            *points,
+            sqrt_weights * np.ravel(residuals),
+            result,
+            greens_function,
+        )
+        return result / scale
+
+    operator = LinearOperator(
+        shape=(n_data, n_points), matvec=matvec, rmatvec=rmatvec, dtype=np.float64
+    )
+    coefs, stop_reason = lsqr(
+        operator,
+        sqrt_weights * data,
+        damp=np.sqrt(damping),
+        atol=1e-10,
+        btol=1e-10,
+        iter_lim=MAX_LSQR_ITERATIONS,
+    )[:2]
+    if stop_reason == 7:
+        warn("LSQR reached the iteration limit before converging.")
+    return coefs / scale
 
 
 def pop_extra_coords(kwargs):
@@ -13,12 +13,17 @@ import numpy as np
 import numpy.testing as npt
 import verde as vd
 import verde.base as vdb
+from numba import jit
 
 from .. import EQLHarmonic, EQLHarmonicSpherical, point_mass_gravity
-from ..equivalent_layer.harmonic import greens_func_cartesian
+from ..equivalent_layer.harmonic import greens_func_cartesian, jacobian_numpy
 from ..equivalent_layer.utils import (
     jacobian_numba,
+    predict_numba,
     pop_extra_coords,
+    least_squares,
+    least_squares_matrix_free,
+    BLOCK_POINTS,
 )
 from .utils import require_numba
 
@@ -177,7 +182,7 @@ def test_eql_harmonic_jacobian_cartesian():
     coordinates = vdb.n_1d_arrays((easting, northing, upward), n=3)
     n_points = points[0].size
     jacobian = np.zeros((n_points, n_points), dtype=points[0].dtype)
-    jacobian_numba(coordinates, points, jacobian, greens_func_cartesian)
+    jacobian_numba(*coordinates, *points, jacobian, greens_func_cartesian)
     # All diagonal elements must be equal
     diagonal = np.diag_indices(4)
     npt.assert_allclose(jacobian[diagonal][0], jacobian[diagonal])
@@ -192,6 +197,239 @@ def test_eql_harmonic_jacobian_cartesian():
     npt.assert_allclose(jacobian[nearest_neighbours][0], jacobian[nearest_neighbours])
 
 
+@pytest.mark.use_numba
+def test_eql_harmonic_jacobian_numpy():
+    """
+    Check that the NumPy and Numba Jacobian matrices are equal
+    """
+    region = (-3e3, -1e3, 5e3, 7e3)
+    coordinates = vdb.n_1d_arrays(
+        vd.grid_coordinates(region=region, shape=(8, 8), extra_coords=0), n=3
+    )
+    points = vdb.n_1d_arrays(
+        vd.grid_coordinates(region=region, shape=(6, 6), extra_coords=-1e3), n=3
+    )
+    jacobian = np.zeros((coordinates[0].size, points[0].size))
+    jacobian_numba(*coordinates, *points, jacobian, greens_func_cartesian)
+    npt.assert_allclose(
+        jacobian, jacobian_numpy(coordinates, points, greens_func_cartesian)
+    )
+
+
+@jit(nopython=True)
+def greens_func_squared(east, north, upward, point_east, point_north, point_upward):
+    """
+    Inverse squared distance used as a custom Green's function in the tests
+    """
+    return 1 / (
+        (east - point_east) ** 2
+        + (north - point_north) ** 2
+        + (upward - point_upward) ** 2
+    )
+
+
+@pytest.mark.use_numba
+def test_eql_harmonic_custom_greens_function(monkeypatch):
+    """
+    Check that the NumPy and Numba paths use the same custom Green's function
+    """
+    region = (-3e3, -1e3, 5e3, 7e3)
+    coordinates = vdb.n_1d_arrays(
+        vd.grid_coordinates(region=region, shape=(8, 8), extra_coords=0), n=3
+    )
+    data = np.linspace(1, 2, coordinates[0].size)
+    eql = EQLHarmonic(relative_depth=1e3)
+    eql.greens_function = greens_func_squared
+    eql.fit(coordinates, data)
+    jacobian = np.zeros((coordinates[0].size, eql.points_[0].size))
+    jacobian_numba(*coordinates, *eql.points_, jacobian, greens_func_squared)
+    npt.assert_allclose(jacobian, eql.jacobian(coordinates, eql.points_))
+    predicted = eql.predict(coordinates)
+    # Use the Numba kernels on every problem
+    monkeypatch.setattr("harmonica.equivalent_layer.harmonic.MAX_NUMPY_SIZE", 0)
+    npt.assert_allclose(jacobian, eql.jacobian(coordinates, eql.points_))
+    npt.assert_allclose(predicted, eql.predict(coordinates))
+
+
+@pytest.mark.use_numba
+def test_eql_harmonic_blocks_cartesian():
+    """
+    Check Jacobian and predictions when the number of point sources is not a
+    multiple of the block size.
+    """
+    n_data, n_points = 71, 2 * BLOCK_POINTS + 13
+    coordinates = tuple(np.linspace(0, 1e3, n_data) for _ in range(3))
+    points = (
+        np.linspace(0, 1e3, n_points),
+        np.linspace(0, 1e3, n_points),
+        np.full(n_points, -500.0),
+    )
+    coeffs = np.linspace(1, 2, n_points)
+    jacobian = np.zeros((n_data, n_points))
+    jacobian_numba(*coordinates, *points, jacobian, greens_func_cartesian)
+    expected = 1 / np.sqrt(
+        sum(
+            (coord[:, np.newaxis] - point) ** 2
+            for coord, point in zip(coordinates, points)
+        )
+    )
+    npt.assert_allclose(expected, jacobian)
+    predicted = np.zeros(n_data)
+    predict_numba(*coordinates, *points, coeffs, predicted, greens_func_cartesian)
+    npt.assert_allclose(expected @ coeffs, predicted)
+
+
+@pytest.mark.parametrize("weights", [None, "random"])
+def test_least_squares(weights):
+    """
+    Check that the LAPACK based solver matches the one from Verde
+    """
+    # Use more columns than the ones scaled at once by least_squares
+    jacobian = np.random.RandomState(0).uniform(1, 2, size=(400, 300))
+    data = jacobian @ np.linspace(-1, 1, 300)
+    if weights == "random":
+        weights = np.random.RandomState(1).uniform(1, 2, size=data.size)
+    for damping in (None, 1e-2):
+        npt.assert_allclose(
+            vdb.least_squares(jacobian, data, weights, damping, copy_jacobian=True),
+            least_squares(jacobian.copy(), data, weights, damping),
+        )
+
+
+@pytest.mark.parametrize("damping", [None, 1e-2])
+def test_least_squares_non_finite(damping):
+    """
+    Check that the LAPACK based solver raises errors on non-finite input
+    """
+    jacobian = np.random.RandomState(0).uniform(1, 2, size=(20, 10))
+    data = jacobian @ np.linspace(-1, 1, 10)
+    for value in (np.inf, np.nan):
+        bad_jacobian = jacobian.copy()
+        bad_jacobian[3, 4] = value
+        with pytest.raises(ValueError, match="Jacobian"):
+            least_squares(bad_jacobian, data, None, damping)
+        bad_data = data.copy()
+        bad_data[3] = value
+        with pytest.raises(ValueError, match="data"):
+            least_squares(jacobian.copy(), bad_data, None, damping)
+        weights = np.ones_like(data)
+        weights[3] = value
+        with pytest.raises(ValueError, match="weights"):
+            least_squares(jacobian.copy(), data, weights, damping)
+
+
+@pytest.mark.use_numba
+@pytest.mark.parametrize("weights", [None, "random"])
+def test_least_squares_matrix_free(weights):
+    """
+    Check that the matrix-free solver matches the one using the Jacobian
+    """
+    region = (-3e3, -1e3, 5e3, 7e3)
+    points = vd.grid_coordinates(region=region, shape=(6, 6), extra_coords=-1e3)
+    masses = vd.datasets.CheckerBoard(amplitude=1e13, region=region).predict(points)
+    coordinates = vdb.n_1d_arrays(
+        vd.grid_coordinates(region=region, shape=(10, 10), extra_coords=0), n=3
+    )
+    data = point_mass_gravity(coordinates, points, masses, field="g_z")
+    if weights == "random":
+        weights = np.random.RandomState(0).uniform(1, 2, size=data.size)
+    eql = EQLHarmonic(relative_depth=500, damping=1e-3)
+    eql.fit(coordinates, data, weights)
+    coefs = least_squares_matrix_free(
+        coordinates, eql.points_, data, weights, eql.damping, greens_func_cartesian
+    )
+    npt.assert_allclose(eql.coefs_, coefs, rtol=1e-4)
+    # The matrix-free solver doesn't converge without damping
+    with pytest.raises(ValueError):
+        least_squares_matrix_free(
+            coordinates, eql.points_, data, weights, None, greens_func_cartesian
+        )
+    # Non-finite elements of the Jacobian are rejected before running LSQR
+    bad_points = tuple(i.copy() for i in eql.points_)
+    bad_points[2][0] = np.nan
+    with pytest.raises(ValueError, match="Jacobian"):
+        least_squares_matrix_free(
+            coordinates, bad_points, data, weights, 1e-3, greens_func_cartesian
+        )
+
+
+@pytest.mark.use_numba
+@pytest.mark.parametrize(
+    "eql_class, module, upward",
+    [
+        (EQLHarmonic, "harmonic", 0),
+        (EQLHarmonicSpherical, "harmonic_spherical", 6400e3),
+    ],
+)
+def test_eql_harmonic_fit_large_problem(monkeypatch, eql_class, module, upward):
+    """
+    Check the fit of large problems with and without damping
+    """
+    region = (-70, -60, -40, -30) if upward else (-3e3, -1e3, 5e3, 7e3)
+    relative_depth = 500e3 if upward else 500
+    points = vd.grid_coordinates(
+        region=region, shape=(6, 6), extra_coords=upward - 2 * relative_depth
+    )
+    masses = vd.datasets.CheckerBoard(amplitude=1e13, region=region).predict(points)
+    coordinates = vd.grid_coordinates(region=region, shape=(8, 8), extra_coords=upward)
+    data = point_mass_gravity(
+        coordinates,
+        points,
+        masses,
+        field="g_z",
+        coordinate_system="spherical" if upward else "cartesian",
+    )
+    damped = eql_class(relative_depth=relative_depth, damping=1e-3)
+    undamped = eql_class(relative_depth=relative_depth)
+    damped.fit(coordinates, data)
+    undamped.fit(coordinates, data)
+    # Consider every problem too large to build its Jacobian matrix
+    monkeypatch.setattr(
+        "harmonica.equivalent_layer.{}.MAX_JACOBIAN_SIZE".format(module), 0
+    )
+    coefs = damped.coefs_
+    npt.assert_allclose(coefs, damped.fit(coordinates, data).coefs_, rtol=1e-4)
+    # Without damping the full Jacobian is built anyway
+    coefs = undamped.coefs_
+    with warnings.catch_warnings(record=True) as warn:
+        warnings.simplefilter("always")
+        undamped.fit(coordinates, data)
+        assert len(warn) == 1
+        assert issubclass(warn[0].category, UserWarning)
+    npt.assert_allclose(coefs, undamped.coefs_)
+
+
+@pytest.mark.use_numba
+@pytest.mark.parametrize(
+    "eql_class, module, upward",
+    [
+        (EQLHarmonic, "harmonic", 0),
+        (EQLHarmonicSpherical, "harmonic_spherical", 6400e3),
+    ],
+)
+@pytest.mark.parametrize("shape", [(5, 5), (20, 20)])
+@pytest.mark.parametrize("matrix_free", [False, True])
+def test_eql_harmonic_coincident_points(
+    monkeypatch, eql_class, module, upward, shape, matrix_free
+):
+    """
+    Check that fitting point sources located on the data points raises errors
+    """
+    region = (-70, -60, -40, -30) if upward else (-3e3, -1e3, 5e3, 7e3)
+    coordinates = vd.grid_coordinates(region=region, shape=shape, extra_coords=upward)
+    data = np.ones_like(coordinates[0])
+    if matrix_free:
+        monkeypatch.setattr(
+            "harmonica.equivalent_layer.{}.MAX_JACOBIAN_SIZE".format(module), 0
+        )
+    for damping in (None, 1e-3):
+        eql = eql_class(relative_depth=0, damping=damping)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with pytest.raises(ValueError, match="observation point"):
+                eql.fit(coordinates, data)
+
+
 @require_numba
 def test_eql_harmonic_spherical():
     """